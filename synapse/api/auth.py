@@ -56,6 +56,9 @@ AuthEventTypes = (
 # guests always get this device id.
 GUEST_DEVICE_ID = "guest_device"
 
+# the expected prefix of the Authorization header, followed by the access token.
+_BEARER_PREFIX = b"Bearer "
+
 
 class _InvalidMacaroonException(Exception):
     pass
@@ -603,11 +606,14 @@ class Auth:
                 )
             if len(auth_headers) > 1:
                 raise MissingClientTokenError("Too many Authorization headers.")
-            parts = auth_headers[0].split(b" ")
-            if parts[0] == b"Bearer" and len(parts) == 2:
-                return parts[1].decode("ascii")
-            else:
-                raise MissingClientTokenError("Invalid Authorization header.")
+            # This is checked on every authenticated request, so we avoid
+            # splitting the header into a list.
+            auth_header = auth_headers[0]
+            if auth_header.startswith(_BEARER_PREFIX):
+                token = auth_header[len(_BEARER_PREFIX) :]
+                if b" " not in token:
+                    return token.decode("ascii")
+            raise MissingClientTokenError("Invalid Authorization header.")
         else:
             # Try to get the access_token from the query params.
             if not query_params:
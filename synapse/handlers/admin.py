@@ -15,11 +15,14 @@
 
 import abc
 import logging
+from collections import defaultdict
 from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
 
 from synapse.api.constants import Membership
 from synapse.events import EventBase
+from synapse.logging.context import make_deferred_yieldable, run_in_background
 from synapse.types import JsonDict, RoomStreamToken, StateMap, UserID
+from synapse.util.async_helpers import concurrently_execute
 from synapse.visibility import filter_events_for_client
 
 from ._base import BaseHandler
@@ -29,6 +32,18 @@ if TYPE_CHECKING:
 
 logger = logging.getLogger(__name__)
 
+# Yield to the reactor every N events processed when exporting a room, so we
+# don't block it for too long.
+_AWAIT_AFTER_ITERATIONS = 1000
+
+# The memberships of the rooms we include when exporting a user's data.
+_EXPORT_MEMBERSHIPS = (
+    Membership.JOIN,
+    Membership.LEAVE,
+    Membership.BAN,
+    Membership.INVITE,
+)
+
 
 class AdminHandler(BaseHandler):
     def __init__(self, hs: "HomeServer"):
@@ -37,6 +52,19 @@ class AdminHandler(BaseHandler):
         self.storage = hs.get_storage()
         self.state_store = self.storage.state
 
+        # The number of events to fetch from the database at a time when
+        # exporting a user's data. Larger batches mean fewer round trips, at
+        # the cost of holding more events in memory at once: as we read one
+        # page ahead, up to two batches are held at any one time.
+        self._export_batch_size = 1000
+
+        # The number of state lookups to run at once when exporting a user's
+        # data. Exports are run by `synapse.app.admin_cmd`, which has its own
+        # database connection pool. This matches the default size of that pool
+        # (`cp_max` defaults to 5); with SQLite the pool has a single
+        # connection, so the lookups are serialised by the pool regardless.
+        self._export_state_concurrency = 5
+
     async def get_whois(self, user: UserID) -> JsonDict:
         connections = []
 
@@ -81,13 +109,7 @@ class AdminHandler(BaseHandler):
         """
         # Get all rooms the user is in or has been in
         rooms = await self.store.get_rooms_for_local_user_where_membership_is(
-            user_id,
-            membership_list=(
-                Membership.JOIN,
-                Membership.LEAVE,
-                Membership.BAN,
-                Membership.INVITE,
-            ),
+            user_id, membership_list=_EXPORT_MEMBERSHIPS
         )
 
         # We only try and fetch events for rooms the user has been in. If
@@ -95,6 +117,19 @@ class AdminHandler(BaseHandler):
         # those separately.
         rooms_user_has_been_in = await self.store.get_rooms_user_has_been_in(user_id)
 
+        # Fetch the set of forgotten rooms and any pending invites up front,
+        # rather than querying the database for each room in turn.
+        forgotten_rooms = await self.store.get_forgotten_rooms_for_user(user_id)
+
+        invite_event_ids = [
+            room.event_id
+            for room in rooms
+            if room.membership == Membership.INVITE
+            and room.room_id not in rooms_user_has_been_in
+            and room.room_id not in forgotten_rooms
+        ]
+        invites = await self.store.get_events(invite_event_ids)
+
         for index, room in enumerate(rooms):
             room_id = room.room_id
 
@@ -102,9 +137,8 @@ class AdminHandler(BaseHandler):
                 "[%s] Handling room %s, %d/%d", user_id, room_id, index + 1, len(rooms)
             )
 
-            forgotten = await self.store.did_forget(user_id, room_id)
-            if forgotten:
-                logger.info("[%s] User forgot room %d, ignoring", user_id, room_id)
+            if room_id in forgotten_rooms:
+                logger.info("[%s] User forgot room %s, ignoring", user_id, room_id)
                 continue
 
             if room_id not in rooms_user_has_been_in:
@@ -113,8 +147,7 @@ class AdminHandler(BaseHandler):
                 # explicitly.
 
                 if room.membership == Membership.INVITE:
-                    event_id = room.event_id
-                    invite = await self.store.get_event(event_id, allow_none=True)
+                    invite = invites.get(room.event_id)
                     if invite:
                         invited_state = invite.unsigned["invite_room_state"]
                         writer.write_invite(room_id, invite, invited_state)
@@ -134,71 +167,115 @@ class AdminHandler(BaseHandler):
 
             # Events that we've processed in this room
             written_events = set()  # type: Set[str]
+            is_written = written_events.__contains__
 
             # We need to track gaps in the events stream so that we can then
             # write out the state at those events. We do this by keeping track
             # of events whose prev events we haven't seen.
 
             # Map from event ID to prev events that haven't been processed,
-            # dict[str, set[str]].
+            # dict[str, set[str]]. Entries are removed once all their prev
+            # events have been processed.
             event_to_unseen_prevs = {}
 
             # The reverse mapping to above, i.e. map from unseen event to events
             # that have the unseen event in their prev_events, i.e. the unseen
             # events "children".
-            unseen_to_child_events = {}  # type: Dict[str, Set[str]]
+            unseen_to_child_events = defaultdict(set)  # type: Dict[str, Set[str]]
 
             # We fetch events in the room the user could see by fetching *all*
             # events that we have and then filtering, this isn't the most
             # efficient method perhaps but it does guarantee we get everything.
-            while True:
-                events, _ = await self.store.paginate_room_events(
-                    room_id, from_key, to_key, limit=100, direction="f"
+            #
+            # We fetch one page ahead, so that the next page is being pulled
+            # from the database while we filter and write out the current one.
+            page, _ = await self.store.paginate_room_events(
+                room_id, from_key, to_key, limit=self._export_batch_size, direction="f"
+            )
+            while page:
+                from_key = page[-1].internal_metadata.after
+                next_page = run_in_background(
+                    self.store.paginate_room_events,
+                    room_id,
+                    from_key,
+                    to_key,
+                    limit=self._export_batch_size,
+                    direction="f",
                 )
-                if not events:
-                    break
-
-                from_key = events[-1].internal_metadata.after
-
-                events = await filter_events_for_client(self.storage, user_id, events)
 
-                writer.write_events(room_id, events)
+                try:
+                    events = await filter_events_for_client(self.storage, user_id, page)
+
+                    writer.write_events(room_id, events)
+
+                    # Update the extremity tracking dicts
+                    for event in events:
+                        event_id = event.event_id
+
+                        # Check if we have any prev events that haven't been
+                        # processed yet, and add those to the appropriate dicts.
+                        # Events usually only have one or two prev events, so
+                        # filtering them directly is cheaper than building a set
+                        # and diffing it.
+                        unseen_events = {
+                            prev_id
+                            for prev_id in event.prev_event_ids()
+                            if not is_written(prev_id)
+                        }
+                        if unseen_events:
+                            event_to_unseen_prevs[event_id] = unseen_events
+                            for unseen in unseen_events:
+                                unseen_to_child_events[unseen].add(event_id)
+
+                        # Now check if this event is an unseen prev event, if so
+                        # then we remove this event from the appropriate dicts,
+                        # dropping any children that no longer have unseen prevs.
+                        for child_id in unseen_to_child_events.pop(event_id, ()):
+                            unseen_prevs = event_to_unseen_prevs[child_id]
+                            unseen_prevs.discard(event_id)
+                            if not unseen_prevs:
+                                del event_to_unseen_prevs[child_id]
+
+                        written_events.add(event_id)
+
+                        # We await occasionally when we're working with large rooms
+                        # to ensure that we don't block the reactor loop for too long.
+                        if len(written_events) % _AWAIT_AFTER_ITERATIONS == 0:
+                            await self.clock.sleep(0)
+
+                    logger.debug(
+                        "Written %d events in room %s", len(written_events), room_id
+                    )
+                except Exception:
+                    # Make sure the fetch of the next page doesn't fail unobserved
+                    # (and get logged as an unhandled error) now that we're
+                    # abandoning it.
+                    next_page.addErrback(lambda _: None)
+                    raise
+
+                page, _ = await make_deferred_yieldable(next_page)
 
-                # Update the extremity tracking dicts
-                for event in events:
-                    # Check if we have any prev events that haven't been
-                    # processed yet, and add those to the appropriate dicts.
-                    unseen_events = set(event.prev_event_ids()) - written_events
-                    if unseen_events:
-                        event_to_unseen_prevs[event.event_id] = unseen_events
-                        for unseen in unseen_events:
-                            unseen_to_child_events.setdefault(unseen, set()).add(
-                                event.event_id
-                            )
-
-                    # Now check if this event is an unseen prev event, if so
-                    # then we remove this event from the appropriate dicts.
-                    for child_id in unseen_to_child_events.pop(event.event_id, []):
-                        event_to_unseen_prevs[child_id].discard(event.event_id)
-
-                    written_events.add(event.event_id)
+            logger.info(
+                "[%s] Written %d events in room %s",
+                user_id,
+                len(written_events),
+                room_id,
+            )
 
-                logger.info(
-                    "Written %d events in room %s", len(written_events), room_id
-                )
+            # Extremities are the events who have at least one unseen prev event,
+            # which are exactly those left in `event_to_unseen_prevs`.
+            extremities = list(event_to_unseen_prevs)
 
-            # Extremities are the events who have at least one unseen prev event.
-            extremities = (
-                event_id
-                for event_id, unseen_prevs in event_to_unseen_prevs.items()
-                if unseen_prevs
-            )
-            for event_id in extremities:
-                if not event_to_unseen_prevs[event_id]:
-                    continue
+            async def write_state_at_extremity(event_id: str) -> None:
                 state = await self.state_store.get_state_for_event(event_id)
                 writer.write_state(room_id, event_id, state)
 
+            # The state lookups are independent of each other, so we do a few
+            # at a time without tying up too many database connections.
+            await concurrently_execute(
+                write_state_at_extremity, extremities, self._export_state_concurrency
+            )
+
         return writer.finished()
 
 
@@ -99,6 +99,22 @@ class AuthTestCase(unittest.TestCase):
         self.assertEqual(f.code, 401)
         self.assertEqual(f.errcode, "M_MISSING_TOKEN")
 
+    def test_get_access_token_from_authorization_header(self):
+        request = Mock(args={})
+        request.requestHeaders.getRawHeaders = mock_getRawHeaders(
+            {b"Authorization": [b"Bearer abc"]}
+        )
+        self.assertEqual(Auth.get_access_token_from_request(request), "abc")
+
+    def test_get_access_token_from_invalid_authorization_header(self):
+        for header in (b"Bearer", b"Bearer  abc", b"Bearer a b", b"Basic abc"):
+            request = Mock(args={})
+            request.requestHeaders.getRawHeaders = mock_getRawHeaders(
+                {b"Authorization": [header]}
+            )
+            with self.assertRaises(MissingClientTokenError):
+                Auth.get_access_token_from_request(request)
+
     @defer.inlineCallbacks
     def test_get_user_by_req_appservice_valid_token(self):
         app_service = Mock(
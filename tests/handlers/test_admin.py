@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gc
 from collections import Counter
 
 from mock import Mock
@@ -189,6 +190,132 @@ class ExfiltrateData(unittest.HomeserverTestCase):
         self.assertEqual(counter[(EventTypes.Member, self.user1)], 1)
         self.assertEqual(counter[(EventTypes.Member, self.user2)], 3)
 
+    def test_paginated_private_room(self):
+        """Tests that we write out the same events and state when the room's
+        events are fetched across many pages.
+        """
+        room_id = self.helper.create_room_as(self.user1, tok=self.token1)
+        self.helper.send_state(
+            room_id,
+            EventTypes.RoomHistoryVisibility,
+            body={"history_visibility": "joined"},
+            tok=self.token1,
+        )
+        self.helper.send(room_id, body="Hello!", tok=self.token1)
+        self.helper.join(room_id, self.user2, tok=self.token2)
+        self.helper.send(room_id, body="Hello again!", tok=self.token1)
+        self.helper.leave(room_id, self.user2, tok=self.token2)
+        self.helper.send(room_id, body="Helloooooo!", tok=self.token1)
+        self.helper.join(room_id, self.user2, tok=self.token2)
+        self.helper.send(room_id, body="Helloooooo!!", tok=self.token1)
+
+        # First export the room in a single page, to compare against.
+        writer = Mock()
+        self.get_success(self.admin_handler.export_user_data(self.user2, writer))
+        writer.write_events.assert_called_once()
+        expected_event_ids = [
+            event.event_id for event in writer.write_events.call_args[0][1]
+        ]
+
+        # Now export it again, fetching one event at a time.
+        self.admin_handler._export_batch_size = 1
+
+        writer = Mock()
+        self.get_success(self.admin_handler.export_user_data(self.user2, writer))
+
+        written_events = []
+        for (called_room_id, events), _ in writer.write_events.call_args_list:
+            self.assertEqual(called_room_id, room_id)
+            written_events.extend(events)
+
+        # Every event should have been written exactly once, in order.
+        self.assertEqual([e.event_id for e in written_events], expected_event_ids)
+
+        # The extremities are user2's joins, as the events before each of them
+        # were hidden by the history visibility.
+        join_event_ids = {
+            event.event_id
+            for event in written_events
+            if event.type == EventTypes.Member
+            and event.state_key == self.user2
+            and event.membership == "join"
+        }
+        self.assertEqual(len(join_event_ids), 2)
+
+        state_event_ids = set()
+        for (called_room_id, event_id, _), _ in writer.write_state.call_args_list:
+            self.assertEqual(called_room_id, room_id)
+            state_event_ids.add(event_id)
+        self.assertEqual(writer.write_state.call_count, 2)
+        self.assertEqual(state_event_ids, join_event_ids)
+
+    def test_forgotten_room(self):
+        """Tests that we don't write anything for rooms the user has forgotten,
+        while still writing out invites to other rooms.
+        """
+        room_id = self.helper.create_room_as(self.user1, tok=self.token1)
+        self.helper.send(room_id, body="Hello!", tok=self.token1)
+        self.helper.join(room_id, self.user2, tok=self.token2)
+        self.helper.send(room_id, body="Hello again!", tok=self.token1)
+        self.helper.leave(room_id, self.user2, tok=self.token2)
+
+        channel = self.make_request(
+            "POST", "/rooms/%s/forget" % (room_id,), {}, access_token=self.token2
+        )
+        self.assertEqual(channel.code, 200, channel.result)
+
+        invite_room_id = self.helper.create_room_as(self.user1, tok=self.token1)
+        self.helper.invite(invite_room_id, self.user1, self.user2, tok=self.token1)
+
+        writer = Mock()
+
+        self.get_success(self.admin_handler.export_user_data(self.user2, writer))
+
+        writer.write_events.assert_not_called()
+        writer.write_state.assert_not_called()
+        writer.write_invite.assert_called_once()
+
+        args = writer.write_invite.call_args[0]
+        self.assertEqual(args[0], invite_room_id)
+        self.assertEqual(args[1].content["membership"], "invite")
+
+    def test_paginated_write_failure(self):
+        """Tests that if writing out a page of events fails, the error is
+        raised and the abandoned fetch of the next page doesn't fail unobserved.
+        """
+        room_id = self.helper.create_room_as(self.user1, tok=self.token1)
+        self.helper.send(room_id, body="Hello!", tok=self.token1)
+        self.helper.join(room_id, self.user2, tok=self.token2)
+        self.helper.send(room_id, body="Hello again!", tok=self.token1)
+
+        self.admin_handler._export_batch_size = 1
+
+        # Only the first page can be fetched, so that the fetch of the next
+        # page, which runs in the background, fails.
+        store = self.hs.get_datastore()
+        paginate_room_events = store.paginate_room_events
+        pages_fetched = []
+
+        async def failing_paginate_room_events(*args, **kwargs):
+            if pages_fetched:
+                raise Exception("Failed to fetch page")
+            pages_fetched.append(args)
+            return await paginate_room_events(*args, **kwargs)
+
+        store.paginate_room_events = failing_paginate_room_events
+
+        writer = Mock()
+        writer.write_events.side_effect = ValueError("Failed to write events")
+
+        self.get_failure(
+            self.admin_handler.export_user_data(self.user2, writer), ValueError
+        )
+        writer.write_events.assert_called_once()
+
+        # Nothing should have been logged as an unhandled error in a Deferred.
+        gc.collect()
+        self.assertEqual(self.flushLoggedErrors(), [])
+
     def test_invite(self):
         """Tests that pending invites get handled correctly.
         """